@@ -1,15 +1,70 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager, suppress
+from fastapi import FastAPI, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.responses import HTMLResponse
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
 from pathlib import Path
-from pydantic import BaseModel
-from typing import List
+from pydantic import BaseModel, TypeAdapter, ValidationError
+from typing import Dict, Iterator, List, Tuple
 import uvicorn
-import json
+import asyncio
+import gzip
+import logging
+import orjson
+import os
 from collections import Counter
+from heapq import nlargest
+from html import escape
+from operator import itemgetter
 import httpx  # <--- NEW
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Startup: create one shared HTTP client for the ESP (keep-alive connections
+    are reused), load drink counts and start the order writer.
+    Shutdown: flush queued orders, save counts, close the client.
+    """
+    # Limits must be set on the transport: a custom transport ignores the
+    # client's own limits. The ESP8266 only speaks HTTP/1.1.
+    transport = httpx.AsyncHTTPTransport(
+        retries=1,
+        http2=False,
+        limits=httpx.Limits(
+            max_connections=100,
+            max_keepalive_connections=20,
+            keepalive_expiry=15.0,
+        ),
+    )
+    app.state.http = httpx.AsyncClient(
+        transport=transport,
+        timeout=httpx.Timeout(8.0, connect=3.0),
+        headers={"Connection": "keep-alive"},
+    )
+    migrate_legacy_orders()
+    # Pay the counts load here, before the first request arrives.
+    app.state.counts = load_counts()
+    write_static_assets()
+    app.state.orders = asyncio.Queue()
+    writer = asyncio.create_task(order_writer(app.state.orders, app.state.counts))
+    yield
+    await app.state.orders.join()
+    writer.cancel()
+    with suppress(asyncio.CancelledError):
+        await writer
+    save_counts(app.state.counts)
+    await app.state.http.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+# Compresses the HTML/JSON pages; images are excluded by default.
+# GZip rewrites response headers in place, so handlers must never return a
+# shared module-level Response object; cache bytes and build a new response.
+app.add_middleware(GZipMiddleware, minimum_size=500)
 
 # ---------- Static files for images ----------
 BASE_DIR = Path(__file__).resolve().parent
@@ -22,54 +77,152 @@ ESP_BASE_URL = "http://172.20.10.3"   # <-- your ESP IP
 ESP_ENDPOINT = "/make-drink"
 
 
-async def send_to_esp(items: list):
+async def send_to_esp(items: list, client: httpx.AsyncClient):
     """
-    Send order to ESP8266.
-    Payload format:
-      {"items":[{"drinkId":..., "drinkName":..., "quantity":..., "calories":...}, ...]}
+    Send order to ESP8266 using the shared client.
+    The robot only needs the drink and how many, so the payload is compact:
+      {"i":[["voltage_fizz", 2], ...]}   # [drinkId, quantity]
     """
     url = f"{ESP_BASE_URL}{ESP_ENDPOINT}"
-    payload = {"items": items}
+    compact = [[i.drinkId, i.quantity] for i in items]
 
-    timeout = httpx.Timeout(8.0, connect=3.0)
-    async with httpx.AsyncClient(timeout=timeout) as client:
-        r = await client.post(url, json=payload)
-        r.raise_for_status()
-        return r.json()
+    r = await client.post(
+        url,
+        content=orjson.dumps({"i": compact}),
+        headers={"Content-Type": "application/json"},
+    )
+    r.raise_for_status()
+    return orjson.loads(r.content)
 
 
 # ---------- Simple order history storage ----------
-ORDERS_FILE = BASE_DIR / "orders.json"
+# Append-only log: one JSON object per line, so a checkout never rewrites history.
+ORDERS_FILE = BASE_DIR / "orders.jsonl"
+LEGACY_ORDERS_FILE = BASE_DIR / "orders.json"
+
+
+def migrate_legacy_orders():
+    """
+    One-time conversion of the old orders.json array into orders.jsonl.
+    The old file is left in place.
+    """
+    if ORDERS_FILE.exists() or not LEGACY_ORDERS_FILE.exists():
+        return
+    orders = orjson.loads(LEGACY_ORDERS_FILE.read_bytes())
+    # Write to a temp file first so a crash can't leave a half-migrated log.
+    tmp = ORDERS_FILE.with_name(ORDERS_FILE.name + ".tmp")
+    tmp.write_bytes(b"".join(orjson.dumps(i) + b"\n" for i in orders))
+    os.replace(tmp, ORDERS_FILE)
 
 
-def load_orders() -> list:
-    """Load all past orders from orders.json."""
+def iter_orders() -> Iterator[dict]:
+    """Yield past order items from orders.jsonl one line at a time."""
     if not ORDERS_FILE.exists():
-        return []
-    with open(ORDERS_FILE, "r") as f:
-        return json.load(f)
+        return
+    with open(ORDERS_FILE, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield orjson.loads(line)
 
 
-def save_orders(orders: list):
-    """Save all orders back to orders.json."""
-    with open(ORDERS_FILE, "w") as f:
-        json.dump(orders, f, indent=2)
+def append_orders(items: list):
+    """Append new order items to orders.jsonl in a single write."""
+    with open(ORDERS_FILE, "ab") as f:
+        f.write(b"".join(orjson.dumps(i) + b"\n" for i in items))
 
 
-def get_top_drinks(limit: int = 3) -> List[str]:
-    """Return top-N drink names by total quantity ordered."""
-    orders = load_orders()
-    if not orders:
-        return []
+# ---------- Drink counts sidecar ----------
+# Running totals per drink, kept in memory (app.state.counts) so recommendations
+# never have to re-scan the whole history. Saved to disk on shutdown.
+COUNTS_FILE = BASE_DIR / "orders_counts.json"
+
 
-    counter = Counter()
-    for item in orders:
+def build_counts() -> Counter:
+    """Count total quantity per drink name from the full order log."""
+    counts = Counter()
+    for item in iter_orders():
         name = item.get("drinkName")
-        qty = int(item.get("quantity", 1))
         if name:
-            counter[name] += qty
+            counts[name] += int(item.get("quantity", 1))
+    return counts
+
+
+def _orders_log_size() -> int:
+    try:
+        return ORDERS_FILE.stat().st_size
+    except FileNotFoundError:
+        return 0
+
 
-    return [name for name, _ in counter.most_common(limit)]
+def save_counts(counts: Counter):
+    """
+    Save drink counts to orders_counts.json in a single write, together with
+    the size of orders.jsonl they were counted up to.
+    """
+    # Write a temp file and swap it in, so a crash mid-write can't leave a
+    # truncated sidecar behind.
+    tmp = COUNTS_FILE.with_name(COUNTS_FILE.name + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps({"log_size": _orders_log_size(), "counts": counts}))
+    os.replace(tmp, COUNTS_FILE)
+
+
+def load_counts() -> Counter:
+    """
+    Load drink counts from orders_counts.json.
+    Rebuilds from the order log if the sidecar is missing, unreadable, or was
+    not saved against the current log (e.g. the server stopped without saving it).
+    """
+    if not COUNTS_FILE.exists():
+        return build_counts()
+    try:
+        with open(COUNTS_FILE, "rb") as f:
+            saved = orjson.loads(f.read())
+    except orjson.JSONDecodeError:
+        return build_counts()
+    if not isinstance(saved, dict) or saved.get("log_size") != _orders_log_size():
+        return build_counts()
+    return Counter(saved["counts"])
+
+
+def record_counts(counts: Counter, items: list):
+    """Add new order items to the in-memory drink counts."""
+    for item in items:
+        counts[item["drinkName"]] += int(item["quantity"])
+
+
+def get_top_drinks(counts: Counter, limit: int = 3) -> List[str]:
+    """Return top-N drink names by total quantity ordered."""
+    # O(N log k) partial selection instead of sorting every drink.
+    return [name for name, _ in nlargest(limit, counts.items(), key=itemgetter(1))]
+
+
+async def order_writer(queue: asyncio.Queue, counts: Counter):
+    """
+    Single writer for the order log and counts.
+    Drains whatever checkouts are queued and saves them with one append.
+    """
+    while True:
+        items = list(await queue.get())
+        batches = 1
+        while not queue.empty():
+            items.extend(queue.get_nowait())
+            batches += 1
+        try:
+            append_orders(items)
+            record_counts(counts, items)
+        except Exception:
+            # Keep the writer alive: if it died, later orders would never be
+            # saved and shutdown would hang on queue.join(). The order already
+            # went to the robot, so log the items for manual recovery.
+            logger.exception(
+                "Could not save %d order item(s); dropped items: %s",
+                len(items),
+                orjson.dumps(items).decode(),
+            )
+        finally:
+            for _ in range(batches):
+                queue.task_done()
 
 
 # ---------- Pydantic model for items from frontend ----------
@@ -80,10 +233,38 @@ class OrderItem(BaseModel):
     calories: int
 
 
+# Built once; validates / dumps a whole order list in a single call.
+_ORDERS_ADAPTER = TypeAdapter(List[OrderItem])
+
+
+# ---------- Drink menu ----------
+# Served to the builder page as static/drinks.json.
+DRINKS_LIST = [
+    {"id": "voltage_fizz", "name": "Voltage Fizz", "calories": 117},  # default (index 0)
+    {"id": "tropical_charge", "name": "Tropical Charge", "calories": 86},
+    {"id": "sunset_fizz", "name": "Sunset Fizz", "calories": 87},
+    {"id": "sparkling_citrus_mix", "name": "Sparkling Citrus Mix", "calories": 118},
+    {"id": "golden_breeze", "name": "Golden Breeze", "calories": 64},
+    {"id": "energy_sunrise", "name": "Energy Sunrise", "calories": 67},
+    {"id": "dark_amber", "name": "Dark Amber", "calories": 65},
+    {"id": "crystal_chill", "name": "Crystal Chill", "calories": 56},
+    {"id": "cola_spark", "name": "Cola Spark", "calories": 81},
+    {"id": "classic_fusion", "name": "Classic Fusion", "calories": 76},
+    {"id": "citrus_shine", "name": "Citrus Shine", "calories": 71},
+    {"id": "citrus_cloud", "name": "Citrus Cloud", "calories": 84},
+    {"id": "chaos_punch", "name": "Chaos Punch", "calories": 204},
+    {"id": "amber_storm", "name": "Amber Storm", "calories": 104},
+    {"id": "base_orange_juice", "name": "Orange Juice", "calories": 45},
+    {"id": "base_water", "name": "Water", "calories": 0},
+    {"id": "base_coca_cola", "name": "Coca-Cola", "calories": 140},
+    {"id": "base_sprite", "name": "Sprite", "calories": 140},
+    {"id": "base_ginger_ale", "name": "Ginger Ale", "calories": 120},
+    {"id": "base_red_bull", "name": "Red Bull", "calories": 110},
+]
+
+
 # ---------- Frontend page (builder) ----------
-@app.get("/", response_class=HTMLResponse)
-async def builder():
-    return HTMLResponse("""
+BUILDER_HTML = """
 <!DOCTYPE html>
 <html>
 <head>
@@ -198,6 +379,7 @@ async def builder():
             color: #1f130d;
         }
         button:hover { opacity: 0.9; }
+        button:disabled { opacity: 0.5; cursor: default; }
         .summary-card {
             margin-top: 22px;
             background: #f8eddc;
@@ -235,7 +417,7 @@ async def builder():
         </div>
 
         <div class="btn-row">
-            <button id="addDrinkBtn">+ Add Drink</button>
+            <button id="addDrinkBtn" disabled>+ Add Drink</button>
             <button id="viewSummaryBtn" class="secondary">View Order Summary</button>
             <button id="clearBtn" class="secondary">Clear Order</button>
             <button id="checkoutBtn">Complete Order</button>
@@ -254,28 +436,7 @@ async def builder():
 </div>
 
 <script>
-const DRINKS = [
-  { id: "voltage_fizz", name: "Voltage Fizz", calories: 117 }, // default (index 0)
-  { id: "tropical_charge", name: "Tropical Charge", calories: 86 }, 
-  { id: "sunset_fizz", name: "Sunset Fizz", calories: 87 },
-  { id: "sparkling_citrus_mix", name: "Sparkling Citrus Mix", calories: 118 },
-  { id: "golden_breeze", name: "Golden Breeze", calories: 64 }, 
-  { id: "energy_sunrise", name: "Energy Sunrise", calories: 67 }, 
-  { id: "dark_amber", name: "Dark Amber", calories: 65 }, 
-  { id: "crystal_chill", name: "Crystal Chill", calories: 56 }, 
-  { id: "cola_spark", name: "Cola Spark", calories: 81 }, 
-  { id: "classic_fusion", name: "Classic Fusion", calories: 76 }, 
-  { id: "citrus_shine", name: "Citrus Shine", calories: 71 }, 
-  { id: "citrus_cloud", name: "Citrus Cloud", calories: 84 },  
-  { id: "chaos_punch", name: "Chaos Punch", calories: 204 },   
-  { id: "amber_storm", name: "Amber Storm", calories: 104 },
-  { id: "base_orange_juice", name: "Orange Juice", calories: 45 },
-  { id: "base_water", name: "Water", calories: 0 },
-  { id: "base_coca_cola", name: "Coca-Cola", calories: 140 },
-  { id: "base_sprite", name: "Sprite", calories: 140 },
-  { id: "base_ginger_ale", name: "Ginger Ale", calories: 120 },
-  { id: "base_red_bull", name: "Red Bull", calories: 110 }
-];
+let DRINKS = [];
 
 let cart = [];
 const CART_STORAGE_KEY = "mocktail_cart_v1_no_ratios";
@@ -397,63 +558,84 @@ drinkSelect.addEventListener("change", () => {
     caloriesNote.textContent = d.calories + " calories • Fixed recipe.";
 });
 
-populateDrinkSelect();
-const initialDrink = getSelectedDrink();
-caloriesNote.textContent = initialDrink.calories + " calories • Fixed recipe.";
-loadCart();
+// "+ Add Drink" stays disabled until the menu has loaded.
+async function init() {
+    loadCart();
+    try {
+        const response = await fetch("/static/drinks.json");
+        if (!response.ok) {
+            throw new Error("Server error " + response.status);
+        }
+        DRINKS = await response.json();
+    } catch (err) {
+        caloriesNote.textContent = "Could not load the drinks menu. Please refresh the page.";
+        alert("Failed to load drinks: " + err.message);
+        return;
+    }
+    populateDrinkSelect();
+    const initialDrink = getSelectedDrink();
+    caloriesNote.textContent = initialDrink.calories + " calories • Fixed recipe.";
+    addDrinkBtn.disabled = false;
+}
+
+init();
 </script>
 </body>
 </html>
-    """)
+"""
+
+_BUILDER_HTML_BYTES = BUILDER_HTML.encode("utf-8")
+BUILDER_FILE = STATIC_DIR / "index.html"
+DRINKS_FILE = STATIC_DIR / "drinks.json"
+
+
+def _write_if_changed(path: Path, data: bytes):
+    # Only rewrite on change so the file's mtime (and StaticFiles' ETag) stays stable.
+    if not path.exists() or path.read_bytes() != data:
+        path.write_bytes(data)
+
+
+def write_static_assets():
+    """Write the builder page and drinks menu into static/ if missing or out of date."""
+    for path, data in ((BUILDER_FILE, _BUILDER_HTML_BYTES), (DRINKS_FILE, orjson.dumps(DRINKS_LIST))):
+        _write_if_changed(path, data)
+        # Precompressed copy for nginx's gzip_static (see nginx.conf).
+        _write_if_changed(path.with_name(path.name + ".gz"), gzip.compress(data, 9, mtime=0))
 
 
 # ---------- Checkout endpoint: SEND to ESP + save history ----------
 @app.post("/checkout")
-async def checkout(items: List[OrderItem]):
-    esp_items = [
-        {
-            "drinkId": i.drinkId,
-            "drinkName": i.drinkName,
-            "quantity": i.quantity,
-            "calories": i.calories
-        }
-        for i in items
-    ]
+async def checkout(request: Request):
+    raw = await request.body()
+    try:
+        items = _ORDERS_ADAPTER.validate_json(raw)
+    except ValidationError as e:
+        # Same error shape FastAPI produces for a declared body parameter.
+        raise RequestValidationError(
+            [{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_url=False)]
+        )
 
     # 1) Send to robot
     try:
-        esp_reply = await send_to_esp(esp_items)
+        esp_reply = await send_to_esp(items, request.app.state.http)
     except Exception as e:
         return {"status": "error", "message": f"Could not reach robot: {str(e)}"}
 
-    # 2) Save order history
-    orders = load_orders()
-    orders.extend(esp_items)
-    save_orders(orders)
+    # 2) Queue order history; the writer task saves it in the background
+    await request.app.state.orders.put(_ORDERS_ADAPTER.dump_python(items))
 
-    return {"status": "ok", "message": "Order sent to robot and saved!", "esp": esp_reply}
+    return {"status": "ok", "message": "Order sent to robot!", "esp": esp_reply}
 
 
 # ---------- Recommendations page ----------
-@app.get("/recommendations", response_class=HTMLResponse)
-async def recommendations():
-    top = get_top_drinks(limit=3)
-
-    if not top:
-        rec_html = "<p>You haven’t placed any orders yet. Start ordering to get recommendations!</p>"
-    else:
-        rec_html = "<ul>"
-        for name in top:
-            rec_html += f"<li>{name}</li>"
-        rec_html += "</ul>"
-
-    html = f"""
+# Only the {rec_html} part changes per request; the rest is encoded once below.
+RECOMMENDATIONS_TEMPLATE = """
     <html>
     <head>
         <meta charset="utf-8" />
         <title>Recommended Drinks</title>
         <style>
-            body {{
+            body {
                 margin: 0;
                 padding: 0;
                 font-family: Arial, sans-serif;
@@ -468,26 +650,26 @@ async def recommendations():
                 align-items: center;
                 justify-content: center;
                 min-height: 100vh;
-            }}
-            .card {{
+            }
+            .card {
                 background: #111;
                 padding: 32px 40px;
                 border-radius: 18px;
                 text-align: center;
                 box-shadow: 0 0 18px rgba(0,0,0,0.5);
-            }}
-            h1 {{
+            }
+            h1 {
                 color: #7dff7d;
                 margin-top: 0;
-            }}
-            button {{
+            }
+            button {
                 margin-top: 18px;
                 padding: 10px 24px;
                 border-radius: 18px;
                 border: none;
                 cursor: pointer;
                 font-size: 14px;
-            }}
+            }
         </style>
     </head>
     <body>
@@ -500,8 +682,61 @@ async def recommendations():
     </body>
     </html>
     """
-    return HTMLResponse(html)
+
+
+_REC_PREFIX, _REC_SUFFIX = RECOMMENDATIONS_TEMPLATE.split("{rec_html}")
+_REC_PREFIX_BYTES = _REC_PREFIX.encode("utf-8")
+_REC_SUFFIX_BYTES = _REC_SUFFIX.encode("utf-8")
+
+# Prebuilt bytes only; each request wraps them in a fresh HTMLResponse.
+_NO_ORDERS_BYTES = b"".join([
+    _REC_PREFIX_BYTES,
+    "<p>You haven’t placed any orders yet. Start ordering to get recommendations!</p>".encode("utf-8"),
+    _REC_SUFFIX_BYTES,
+])
+
+# Last rendered page, keyed by the top drink names it shows.
+_REC_PAGE_CACHE: Dict[Tuple[str, ...], bytes] = {}
+
+
+# Left as async def on purpose: it never blocks (counts are in memory), and a
+# plain def endpoint would be dispatched to Starlette's threadpool instead of
+# running inline on the event loop.
+@app.get("/recommendations", response_class=HTMLResponse)
+async def recommendations(request: Request):
+    top = tuple(get_top_drinks(request.app.state.counts, limit=3))
+
+    if not top:
+        return HTMLResponse(_NO_ORDERS_BYTES)
+
+    page = _REC_PAGE_CACHE.get(top)
+    if page is None:
+        # Drink names come from stored orders, so escape them.
+        rec_html = "<ul>" + "".join(f"<li>{escape(name)}</li>" for name in top) + "</ul>"
+        page = b"".join([_REC_PREFIX_BYTES, rec_html.encode("utf-8"), _REC_SUFFIX_BYTES])
+        _REC_PAGE_CACHE.clear()
+        _REC_PAGE_CACHE[top] = page
+
+    return HTMLResponse(page)
+
+
+# ---------- Builder page, served from disk ----------
+# Mounted last so it does not shadow the routes above; html=True serves
+# index.html for "/" with ETag / If-Modified-Since support.
+app.mount("/", StaticFiles(directory=STATIC_DIR, html=True), name="builder")
 
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8013, reload=True)
+    # uvicorn[standard] provides uvloop and httptools; uvicorn's default "auto"
+    # loop/http settings pick them up when installed.
+    # RELOAD=1 for development. Always a single worker: the drink counts and
+    # the order writer live in process memory. Listens on localhost only,
+    # behind nginx (see nginx.conf); set HOST=0.0.0.0 to expose it directly.
+    reload = os.environ.get("RELOAD") == "1"
+    uvicorn.run(
+        "main:app",
+        host=os.environ.get("HOST", "127.0.0.1"),
+        port=8013,
+        access_log=False,
+        reload=reload,
+    )